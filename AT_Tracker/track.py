@@ -3,18 +3,36 @@ from gsuid_core.models import Event
 from gsuid_core.aps import scheduler
 from gsuid_core.sv import SV
 from gsuid_core.logger import logger
-from gsuid_core.utils.download_resource.download_file import download
-from gsuid_core.utils.image.convert import convert_img
-from typing import Dict, List, Optional
+from gsuid_core.server import on_core_shutdown
+from typing import TYPE_CHECKING, Any, Dict, FrozenSet, List, Optional, Set, Tuple
 from datetime import datetime, timedelta
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
+import io
 import json
 import asyncio
-from collections import deque
-import hashlib
+import bisect
+import errno
+from collections import OrderedDict, deque
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
 import os
 import shutil
+import tempfile
+import time
+import uuid
+
+import aiofiles
+import aiohttp
+
+# Pillow 仅在生成图片与处理图片文件时使用，在函数内按需导入
+if TYPE_CHECKING:
+    from PIL import Image, ImageFont
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from .at_tracker_config import ATTrackerConfig
 from .utils.resource.RESOURCE_PATH import (
@@ -24,11 +42,49 @@ from .utils.resource.RESOURCE_PATH import (
 
 # --- 字体路径 ---
 font_path = Path(__file__).parent / "SourceHanSerifCN-Bold.otf"
+FONT_SIZES = {"cjk": 18, "small": 14, "time": 12}  # 正文/昵称与at/时间
 
 # --- 全局缓存 ---
-message_cache: Dict[int, deque] = {}  # group_id -> deque of messages
-at_records: Dict[int, List[Dict]] = {}  # group_id -> list of at records
-active_at_tracking: Dict[int, List[Dict]] = {}  # group_id -> list of active tracking sessions
+AVATAR_LRU_SIZE = 256
+MESSAGE_CACHE_GROUPS = 512  # 最多同时缓存消息的群组数
+MESSAGE_CACHE_TTL = timedelta(hours=1)  # 超过该时长无新消息的群组缓存会被清除
+AVATAR_SIZE = 45  # 聊天图片中头像的绘制尺寸
+AVATAR_DECODE_SIZE = (AVATAR_SIZE * 2, AVATAR_SIZE * 2)  # 640px 的 JPEG 头像无需完整解码
+_avatar_lru: "OrderedDict[str, Image.Image]" = OrderedDict()  # qq -> 已处理好的圆形头像
+_inflight_avatars: Dict[str, "asyncio.Task[Optional[Image.Image]]"] = {}  # qq -> 进行中的头像获取任务
+
+
+message_cache: "OrderedDict[int, deque]" = OrderedDict()  # group_id -> deque of messages，按最近活跃排序
+# group_id -> list of at records，按群组懒加载，通过 _ensure_group_loaded 读取
+at_records: Dict[int, List[Dict]] = {}
+at_records_by_id: Dict[int, Dict[str, Dict]] = {}  # group_id -> record_id -> at record
+at_records_by_target: Dict[int, Dict[str, Set[str]]] = {}  # group_id -> 被at的qq -> {record_id}
+_group_load_locks: Dict[int, asyncio.Lock] = {}  # group_id -> 读取该群组记录文件时持有的锁
+# group_id -> {(sender_id_str, targets_qq_frozenset): session}
+active_at_tracking: Dict[int, Dict[Tuple[str, FrozenSet[str]], Dict]] = {}
+
+# 记录头信息字段，追踪期间消息以追加日志形式保存，会话结束后写出完整快照
+RECORD_META_KEYS = ("id", "group_id", "sender_id", "targets", "start_time", "associated_images")
+RECORD_FILE_SUFFIXES = (".json", ".meta.json", ".jsonl")
+
+# --- JSON 序列化：优先使用 orjson，不可用时回退到标准库 ---
+if orjson is not None:
+
+    def _dumps(obj, pretty: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+
+    _loads = orjson.loads
+else:
+
+    def _dumps(obj, pretty: bool = False) -> bytes:
+        if pretty:
+            return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    _loads = json.loads
+
+# --- 图片渲染线程池：Pillow 的绘制与编码在 C 层释放 GIL，放到线程中执行不阻塞事件循环 ---
+_render_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="at_tracker_render")
 
 # --- SV定义 ---
 at_tracker_sv = SV("AT追踪", area="GROUP")
@@ -36,16 +92,55 @@ at_tracker_msg = SV("AT追踪消息监听", priority=5, area="GROUP")
 
 
 # --- 配置获取函数 ---
-def get_config(key: str):
-    """获取配置值"""
-    return ATTrackerConfig.get_config(key).data
+CONFIG_CACHE_TTL = 30  # 秒，配置界面中的修改最迟在该时间后生效
+_CFG_CACHE: Dict[str, Tuple[Any, float]] = {}  # key -> (配置值, 过期时间)
+
+
+def get_config(key: str, _c: Dict[str, Tuple[Any, float]] = _CFG_CACHE):
+    """获取配置值（短时缓存，过期后重新读取）"""
+    now = time.monotonic()
+    cached = _c.get(key)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    value = ATTrackerConfig.get_config(key).data
+    _c[key] = (value, now + CONFIG_CACHE_TTL)
+    return value
+
+
+def invalidate_config_cache():
+    """清空配置缓存，下次获取时重新读取"""
+    _CFG_CACHE.clear()
+
+
+# --- 时间工具 ---
+# "%Y%m%d %H:%M:%S" 格式定长且按时间先后排列，可直接以字符串比较代替 strptime
+TIME_STR_LEN = len("20240101 00:00:00")
+_ts_cache = {"s": 0, "date": "", "dt": ""}
+
+
+def now_strs():
+    """返回当前时间的 ("%Y%m%d %H:%M:%S", "%Y%m%d%H%M%S") 字符串，同一秒内复用格式化结果"""
+    s = int(time.time())
+    if s != _ts_cache["s"]:
+        lt = time.localtime(s)
+        _ts_cache.update(
+            s=s,
+            date=time.strftime("%Y%m%d %H:%M:%S", lt),
+            dt=time.strftime("%Y%m%d%H%M%S", lt),
+        )
+    return _ts_cache["date"], _ts_cache["dt"]
+
+
+def get_cutoff_str(retention_days: int) -> str:
+    """返回保留期限的起始时间字符串，早于它的记录视为过期"""
+    return (datetime.now() - timedelta(days=retention_days)).strftime("%Y%m%d %H:%M:%S")
 
 
 # --- 初始化与定时任务 ---
 async def init():
     """初始化插件"""
     logger.debug("AT追踪插件已启动")
-    load_at_records()
+    # 记录按群组懒加载，首次用到某个群组时才读取；启动清理只按文件名判断过期，不读取未过期的记录
     await cleanup_old_records()
 
 
@@ -53,124 +148,604 @@ async def init():
 async def scheduled_cleanup():
     """每日定时执行清理任务"""
     logger.debug("开始执行每日AT记录清理任务...")
+    invalidate_config_cache()
     await cleanup_old_records()
     logger.debug("每日AT记录清理任务执行完毕。")
 
 
+@scheduler.scheduled_job("cron", minute=30, misfire_grace_time=60)
+async def sweep_message_cache():
+    """每小时清除长时间没有新消息的群组的消息缓存"""
+    cutoff_str = (datetime.now() - MESSAGE_CACHE_TTL).strftime("%Y%m%d %H:%M:%S")
+    # 按最近活跃排序，从最久未活跃的一端开始检查
+    stale = []
+    for group_id, messages in message_cache.items():
+        if messages and messages[-1]["time"] >= cutoff_str:
+            break
+        stale.append(group_id)
+    for group_id in stale:
+        del message_cache[group_id]
+    if stale:
+        logger.debug(f"已清除 {len(stale)} 个不活跃群组的消息缓存")
+
+
+def _delete_group_files(group_data_dir: Path, filenames: List[str], existing: Optional[Set[str]] = None):
+    """删除群组数据文件夹中的指定文件，existing 为已知的文件夹内容（不传则重新列出）"""
+    if existing is None:
+        try:
+            with os.scandir(group_data_dir) as it:
+                existing = {entry.name for entry in it}
+        except FileNotFoundError:
+            return
+
+    for filename in filenames:
+        if filename not in existing:
+            continue
+        file_path = group_data_dir / filename
+        try:
+            os.unlink(file_path)
+            logger.debug(f"已删除过期记录文件: {file_path}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"删除文件 {file_path} 失败: {e}")
+
+
+def _record_id_from_filename(name: str) -> Optional[str]:
+    """由记录文件名（快照、头信息或追加日志）取得记录ID，不是记录文件时返回 None"""
+    if not name.startswith("at_record_"):
+        return None
+    for suffix in (".meta.json", ".jsonl", ".json"):
+        if name.endswith(suffix):
+            return name[len("at_record_") : -len(suffix)]
+    return None
+
+
+def _record_id_time(record_id: str) -> Optional[str]:
+    """记录ID形如 {群号}_{%Y%m%d%H%M%S}_{哈希}，返回其中的创建时间，无法解析时返回 None"""
+    parts = record_id.split("_")
+    if len(parts) >= 3 and len(parts[1]) == 14 and parts[1].isdigit():
+        return parts[1]
+    return None
+
+
+def _read_record_images(group_data_dir: Path, record_id: str, names: Set[str]) -> Optional[List[str]]:
+    """读取记录的关联图片（快照优先，其次头信息），读取失败时返回 None"""
+    for suffix in (".json", ".meta.json"):
+        name = f"at_record_{record_id}{suffix}"
+        if name not in names:
+            continue
+        try:
+            return _loads((group_data_dir / name).read_bytes()).get("associated_images", [])
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            logger.warning(f"读取记录 {name} 的关联图片失败: {e}")
+            return None
+    return []
+
+
+def _cleanup_unloaded_group(group_id: int, cutoff_compact: str) -> int:
+    """清理未加载到内存的群组，返回删除的记录数
+
+    按文件名中的创建时间判断过期，只读取过期记录的文件；
+    过期记录带有图片时才读取其余记录，保留仍被引用的图片
+    """
+    group_data_dir = RECORD_PATH / str(group_id)
+    try:
+        with os.scandir(group_data_dir) as it:
+            names = {entry.name for entry in it}
+    except FileNotFoundError:
+        return 0
+
+    expired_ids: Set[str] = set()
+    retained_ids: Set[str] = set()
+    for name in names:
+        record_id = _record_id_from_filename(name)
+        if record_id is None:
+            continue
+        created = _record_id_time(record_id)
+        if created is not None and created < cutoff_compact:
+            expired_ids.add(record_id)
+        else:
+            retained_ids.add(record_id)
+    if not expired_ids:
+        return 0
+
+    expired_images: Set[str] = set()
+    for record_id in expired_ids:
+        expired_images.update(_read_record_images(group_data_dir, record_id, names) or [])
+    # 上下文中的同一张图片可能被多条记录共用，仍被保留的记录引用的图片不删除
+    for record_id in retained_ids:
+        if not expired_images:
+            break
+        images = _read_record_images(group_data_dir, record_id, names)
+        if images is None:
+            # 无法确认引用关系时保守处理，保留全部图片
+            expired_images.clear()
+        else:
+            expired_images.difference_update(images)
+
+    filenames = [f"at_record_{record_id}{suffix}" for record_id in expired_ids for suffix in RECORD_FILE_SUFFIXES]
+    filenames.extend(expired_images)
+    _delete_group_files(group_data_dir, filenames, names)
+    return len(expired_ids)
+
+
+def _delete_expired_files(files_to_delete: Dict[int, List[str]]):
+    """删除过期记录的文件，并移除空的群组数据文件夹"""
+    for group_id, filenames in files_to_delete.items():
+        _delete_group_files(RECORD_PATH / str(group_id), filenames)
+
+    with os.scandir(RECORD_PATH) as it:
+        for entry in it:
+            if not (entry.name.isdigit() and entry.is_dir(follow_symlinks=False)):
+                continue
+            # os.rmdir 只删除空文件夹，期间有新记录写入时会失败而保留该文件夹
+            try:
+                os.rmdir(entry.path)
+                logger.debug(f"已删除空的群组数据文件夹: {entry.path}")
+            except OSError as e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                    logger.error(f"删除空文件夹 {entry.path} 失败: {e}")
+
+
+def _delete_expired_avatars(cutoff_ts: float) -> List[str]:
+    """删除下载时间早于 cutoff_ts 的头像缓存文件，返回被删除头像的QQ号"""
+    removed = []
+    if not AVATAR_CACHE_PATH.exists():
+        return removed
+    with os.scandir(AVATAR_CACHE_PATH) as it:
+        for entry in it:
+            try:
+                if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < cutoff_ts:
+                    os.remove(entry.path)
+                    removed.append(entry.name.split(".", 1)[0])
+            except OSError as e:
+                logger.error(f"删除头像缓存 {entry.path} 失败: {e}")
+    return removed
+
+
 async def cleanup_old_records():
     """删除超过指定天数的旧AT记录和相关文件"""
     logger.debug("开始清理旧的AT记录...")
     retention_days = get_config("RETENTION_DAYS")
-    cutoff_date = datetime.now() - timedelta(days=retention_days)
+    cutoff_str = get_cutoff_str(retention_days)
+    # 记录ID中的创建时间为 "%Y%m%d%H%M%S" 格式
+    cutoff_compact = cutoff_str.replace(" ", "").replace(":", "")
+
+    files_to_delete: Dict[int, List[str]] = {}
+    group_ids = set(at_records) | set(await asyncio.to_thread(_list_group_ids))
+    for group_id in group_ids:
+        records = at_records.get(group_id)
+        if records is None:
+            # 未加载的群组不读入内存，只按文件名判断过期；持有读取锁，避免与加载该群组并发
+            async with _group_load_lock(group_id):
+                if group_id not in at_records:
+                    removed = await asyncio.to_thread(_cleanup_unloaded_group, group_id, cutoff_compact)
+                    if removed:
+                        logger.debug(f"已清理群组 {group_id} 的 {removed} 条过期记录")
+                    continue
+                records = at_records[group_id]
+
+        # 记录按开始时间排序，过期的记录都位于列表前部
+        expired_count = bisect.bisect_left(records, cutoff_str, key=_start_time_key)
+        if not expired_count:
+            continue
 
-    for group_id, records in list(at_records.items()):
         records_to_keep = []
-        for record in records:
+        expired_images: Set[str] = set()
+        for record in records[:expired_count]:
             try:
-                record_time = datetime.strptime(record["start_time"], "%Y%m%d %H:%M:%S")
-                if record_time < cutoff_date:
-                    record_id = record["id"]
-                    group_data_dir = RECORD_PATH / str(group_id)
-
-                    # 删除关联的图片文件
-                    for image_filename in record.get("associated_images", []):
-                        image_path = group_data_dir / image_filename
-                        if image_path.exists():
-                            try:
-                                os.remove(image_path)
-                                logger.debug(f"已删除过期记录关联的图片: {image_path}")
-                            except OSError as e:
-                                logger.error(f"删除图片 {image_path} 失败: {e}")
-
-                    # 删除记录文件本身
-                    file_path = group_data_dir / f"at_record_{record_id}.json"
-                    if file_path.exists():
-                        try:
-                            os.remove(file_path)
-                            logger.debug(f"已删除过期记录文件: {file_path}")
-                        except OSError as e:
-                            logger.error(f"删除记录文件 {file_path} 失败: {e}")
-                else:
-                    records_to_keep.append(record)
-            except (ValueError, KeyError) as e:
+                start_time = record["start_time"]
+                if len(start_time) != TIME_STR_LEN:
+                    raise ValueError(f"无效的开始时间 {start_time!r}")
+                record_id = record["id"]
+                # 记录文件本身（包括未写出快照时的追加日志），关联的图片在下方统一筛选
+                expired_images.update(record.get("associated_images", []))
+                files_to_delete.setdefault(group_id, []).extend(
+                    f"at_record_{record_id}{suffix}" for suffix in RECORD_FILE_SUFFIXES
+                )
+                _remove_record_index(group_id, record)
+            except (ValueError, KeyError, TypeError) as e:
                 logger.warning(f"处理记录时出错，将保留该记录: {record.get('id', 'N/A')}, 错误: {e}")
                 records_to_keep.append(record)
+        records_to_keep.extend(records[expired_count:])
+
+        # 上下文中的同一张图片可能被多条记录共用，仍被保留的记录引用的图片不删除
+        for record in records_to_keep:
+            expired_images.difference_update(record.get("associated_images", []))
+        if expired_images:
+            files_to_delete.setdefault(group_id, []).extend(expired_images)
 
         at_records[group_id] = records_to_keep
 
-    for group_dir in RECORD_PATH.iterdir():
-        if group_dir.is_dir() and not any(group_dir.iterdir()) and group_dir.name.isdigit():
-            try:
-                shutil.rmtree(group_dir)
-                logger.debug(f"已删除空的群组数据文件夹: {group_dir}")
-            except OSError as e:
-                logger.error(f"删除空文件夹 {group_dir} 失败: {e}")
+    # 内存中的记录已在事件循环中更新，文件删除交给线程执行
+    await asyncio.to_thread(_delete_expired_files, files_to_delete)
 
     if get_config("EnableAvatarCache"):
+        # 只清理超过保留天数的头像，常用头像跨天保留，同时保证头像定期重新下载更新
         try:
-            if AVATAR_CACHE_PATH.exists():
-                shutil.rmtree(AVATAR_CACHE_PATH)
+            cutoff_ts = time.time() - retention_days * 86400
+            removed = await asyncio.to_thread(_delete_expired_avatars, cutoff_ts)
+            for qq in removed:
+                _avatar_lru.pop(qq, None)
             AVATAR_CACHE_PATH.mkdir(parents=True, exist_ok=True)
-            logger.info("已清理头像缓存。")
+            logger.info(f"已清理 {len(removed)} 个过期头像缓存。")
         except OSError as e:
             logger.error(f"清理头像缓存失败: {e}")
 
 
 # --- 数据读写 ---
-def load_at_records():
-    """加载本地保存的AT记录"""
-    global at_records
-    at_records = {}
+# 以下划线开头的键为内存中的辅助字段，不写入磁盘
+def _persistable(record: Dict) -> Dict:
+    """去除记录中的内存辅助字段"""
+    return {key: value for key, value in record.items() if not key.startswith("_")}
+
+
+def _index_record(record: Dict) -> Dict:
+    """为记录建立按消息列存储的 发送者/是否含at 辅助列表，供查询时快速扫描"""
+    messages = record.get("messages", [])
+    record["_uids"] = [str(msg.get("user_id")) for msg in messages]
+    record["_at_flags"] = [any(item.get("type") == "at" for item in msg.get("content", [])) for msg in messages]
+    return record
+
+
+def _append_record_message(record: Dict, msg_record: Dict):
+    """向记录追加一条消息，同时维护辅助列表"""
+    record["messages"].append(msg_record)
+    record["_uids"].append(str(msg_record.get("user_id")))
+    record["_at_flags"].append(any(item.get("type") == "at" for item in msg_record.get("content", [])))
+
+
+def _record_file(group_data_dir: Path, record_id: str, suffix: str) -> Path:
+    """AT记录相关文件路径: .json 为完整快照, .meta.json 为头信息, .jsonl 为追加日志"""
+    return group_data_dir / f"at_record_{record_id}{suffix}"
+
+
+def _remove_record_log(group_data_dir: Path, record_id: str):
+    """删除记录的头信息与追加日志"""
+    for suffix in (".meta.json", ".jsonl"):
+        try:
+            os.remove(_record_file(group_data_dir, record_id, suffix))
+        except FileNotFoundError:
+            pass
+
+
+def _write_snapshot(group_data_dir: Path, record_id: str, data: bytes):
+    """写出完整的记录快照（先写临时文件再替换，不会留下写了一半的快照），并清理追加日志"""
+    group_data_dir.mkdir(parents=True, exist_ok=True)
+    snapshot_path = _record_file(group_data_dir, record_id, ".json")
+    fd, tmp_path = tempfile.mkstemp(dir=group_data_dir, prefix=f"{snapshot_path.name}.", suffix=".tmp")
     try:
-        if not RECORD_PATH.exists():
-            return
-        for group_dir in RECORD_PATH.iterdir():
-            if group_dir.is_dir() and group_dir.name.isdigit():
-                try:
-                    group_id = int(group_dir.name)
-                    at_records[group_id] = []
-                    for file_path in group_dir.glob("at_record_*.json"):
-                        with open(file_path, "r", encoding="utf-8") as f:
-                            data = json.load(f)
-                            at_records[group_id].append(data)
-                except (ValueError, json.JSONDecodeError) as e:
-                    logger.error(f"加载群组 {group_dir.name} 的记录失败: {e}")
-    except Exception as e:
-        logger.error(f"加载所有AT记录失败: {e}")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, snapshot_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    _remove_record_log(group_data_dir, record_id)
+
+
+def _write_log(group_data_dir: Path, record_id: str, lines: bytes, meta: Optional[bytes] = None):
+    """向记录的追加日志写入消息，meta 不为空时同时写入头信息"""
+    group_data_dir.mkdir(parents=True, exist_ok=True)
+    if meta is not None:
+        meta_path = _record_file(group_data_dir, record_id, ".meta.json")
+        try:
+            f = open(meta_path, "wb")
+        except FileNotFoundError:
+            # 新群组的空文件夹可能恰好被清理任务删除，重新创建一次
+            group_data_dir.mkdir(parents=True, exist_ok=True)
+            f = open(meta_path, "wb")
+        with f:
+            f.write(meta)
+    with open(_record_file(group_data_dir, record_id, ".jsonl"), "ab") as f:
+        f.write(lines)
+
+
+def _materialize_record(group_data_dir: Path, record_id: str) -> Optional[Dict]:
+    """由头信息与追加日志重建记录，写出完整快照并移除日志文件
+
+    头信息或日志已不存在时（快照已由别处写出），改为读取快照；都不存在时返回 None
+    """
+    snapshot_path = _record_file(group_data_dir, record_id, ".json")
+    try:
+        record = _loads(_record_file(group_data_dir, record_id, ".meta.json").read_bytes())
+        with open(_record_file(group_data_dir, record_id, ".jsonl"), "rb") as f:
+            record["messages"] = [_loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        try:
+            return _loads(snapshot_path.read_bytes())
+        except FileNotFoundError:
+            return None
 
+    _write_snapshot(group_data_dir, record_id, _dumps(record, pretty=True))
+    return record
 
-def save_at_record(record: Dict):
-    """保存AT记录到本地"""
+
+def _start_time_key(record: Dict) -> str:
+    """记录的排序键，每个群组的记录按开始时间升序保存"""
+    start_time = record.get("start_time")
+    return start_time if isinstance(start_time, str) else ""
+
+
+def _list_group_ids() -> List[int]:
+    """列出磁盘上有数据文件夹的群组"""
+    if not RECORD_PATH.exists():
+        return []
+    with os.scandir(RECORD_PATH) as it:
+        return [int(entry.name) for entry in it if entry.name.isdigit() and entry.is_dir(follow_symlinks=False)]
+
+
+def _add_record_index(group_id: int, record: Dict):
+    """将记录加入按 id 与按被at对象的索引"""
+    record_id = record["id"]
+    at_records_by_id.setdefault(group_id, {})[record_id] = record
+    by_target = at_records_by_target.setdefault(group_id, {})
+    for target in record.get("targets", []):
+        by_target.setdefault(str(target.get("qq")), set()).add(record_id)
+
+
+def _remove_record_index(group_id: int, record: Dict):
+    """从索引中移除记录"""
+    record_id = record["id"]
+    at_records_by_id.get(group_id, {}).pop(record_id, None)
+    by_target = at_records_by_target.get(group_id, {})
+    for target in record.get("targets", []):
+        record_ids = by_target.get(str(target.get("qq")))
+        if record_ids is not None:
+            record_ids.discard(record_id)
+
+
+def _set_group_records(group_id: int, records: List[Dict]):
+    """设置群组在内存中的记录并重建其索引"""
+    at_records[group_id] = records
+    at_records_by_id[group_id] = {}
+    at_records_by_target[group_id] = {}
+    for record in records:
+        _add_record_index(group_id, record)
+
+
+def load_at_records(group_id: int) -> List[Dict]:
+    """读取单个群组本地保存的AT记录"""
+    records = []
+    group_dir = RECORD_PATH / str(group_id)
+    try:
+        with os.scandir(group_dir) as it:
+            names = {entry.name for entry in it if entry.name.startswith("at_record_") and entry.is_file()}
+    except (FileNotFoundError, NotADirectoryError):
+        return records
+    except OSError as e:
+        logger.error(f"加载群组 {group_id} 的AT记录失败: {e}")
+        return records
+
+    # 单个文件读取失败只跳过该记录，不影响同群组的其他记录
+    for name in names:
+        try:
+            if name.endswith(".meta.json"):
+                # 没有快照的记录（追踪中途重启），由头信息与追加日志重建
+                record_id = name[len("at_record_") : -len(".meta.json")]
+                if f"at_record_{record_id}.json" in names:
+                    _remove_record_log(group_dir, record_id)
+                    continue
+                record = _materialize_record(group_dir, record_id)
+                if record is not None:
+                    records.append(_index_record(record))
+            elif name.endswith(".json"):
+                with open(group_dir / name, "rb") as f:
+                    records.append(_index_record(_loads(f.read())))
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            logger.error(f"加载群组 {group_id} 的AT记录 {name} 失败: {e}")
+
+    records.sort(key=_start_time_key)
+    return records
+
+
+def _group_load_lock(group_id: int) -> asyncio.Lock:
+    """获取群组的读取锁，读取时可能重建并改写记录文件，同一群组的读取需串行执行"""
+    lock = _group_load_locks.get(group_id)
+    if lock is None:
+        lock = _group_load_locks[group_id] = asyncio.Lock()
+    return lock
+
+
+async def _ensure_group_loaded(group_id: int) -> List[Dict]:
+    """确保群组的记录与索引已加载到内存，读取在线程中进行，返回该群组的记录列表"""
+    records = at_records.get(group_id)
+    if records is not None:
+        return records
+    async with _group_load_lock(group_id):
+        records = at_records.get(group_id)
+        if records is None:
+            records = await asyncio.to_thread(load_at_records, group_id)
+            # 读取期间群组可能已被其他任务写入（如清除命令），以内存中的为准
+            if group_id in at_records:
+                return at_records[group_id]
+            _set_group_records(group_id, records)
+    return records
+
+
+async def save_at_record(
+    record: Dict,
+    mode: str = "snapshot",
+    msg_record: Optional[Dict] = None,
+    messages: Optional[List[Dict]] = None,
+):
+    """保存AT记录到本地
+
+    mode:
+        - "create": 新记录，写入头信息并将创建时的消息 messages（默认为记录中的全部消息）写入追加日志
+        - "append": 向追加日志写入一条新消息 msg_record，关联图片有变化时（_dirty_snapshot）同时重写头信息
+        - "snapshot": 写出完整记录并移除追加日志（会话结束时使用）
+    """
     try:
-        group_id = record["group_id"]
+        group_data_dir = RECORD_PATH / str(record["group_id"])
         record_id = record["id"]
 
-        group_data_dir = RECORD_PATH / str(group_id)
-        group_data_dir.mkdir(parents=True, exist_ok=True)
+        # 序列化在事件循环中完成，避免与其他协程对消息的修改并发；文件写入交给线程
+        if mode == "snapshot":
+            data = _dumps(_persistable(record), pretty=True)
+            await asyncio.to_thread(_write_snapshot, group_data_dir, record_id, data)
+            return
 
-        file_path = group_data_dir / f"at_record_{record_id}.json"
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(record, f, ensure_ascii=False, indent=2)
+        if mode == "create":
+            messages = record["messages"] if messages is None else messages
+        else:
+            messages = [msg_record]
+        lines = b"".join(_dumps(msg) + b"\n" for msg in messages)
+        meta = None
+        if mode == "create" or record.get("_dirty_snapshot"):
+            meta = _dumps({key: record[key] for key in RECORD_META_KEYS}, pretty=True)
+            record["_dirty_snapshot"] = False
+        await asyncio.to_thread(_write_log, group_data_dir, record_id, lines, meta)
     except Exception as e:
         logger.error(f"保存AT记录失败: {e}")
 
 
+def _queue_record_write(record: Dict, write) -> "asyncio.Task":
+    """将记录的写入操作排入该记录的写入队列，按排队顺序依次执行，避免日志行乱序或旧快照覆盖新数据"""
+    prev = record.get("_write_task")
+
+    async def run():
+        if prev is not None:
+            # 前一个写入的异常已在其内部记录，这里只需等待其完成
+            await asyncio.gather(prev, return_exceptions=True)
+        await write
+
+    task = asyncio.ensure_future(run())
+    record["_write_task"] = task
+
+    def done(_):
+        if record.get("_write_task") is task:
+            del record["_write_task"]
+
+    task.add_done_callback(done)
+    return task
+
+
+async def _save_tracked_message(
+    record: Dict,
+    msg_record: Dict,
+    finished: bool,
+    images_task: Optional["asyncio.Task"] = None,
+    msg_images: Optional[List[str]] = None,
+):
+    """保存追踪会话中新增的一条消息；图片下载完成后才写入，会话结束时写出完整快照"""
+    if images_task is not None:
+        await asyncio.gather(images_task, return_exceptions=True)
+        associated_images = record["associated_images"]
+        for img_name in msg_images or []:
+            if img_name not in associated_images:
+                associated_images.append(img_name)
+                record["_dirty_snapshot"] = True
+
+    if finished:
+        # 会话结束，写出包含本条消息的完整快照
+        await save_at_record(record)
+        logger.info(f"AT tracking session for record {record['id']} has finished.")
+    else:
+        await save_at_record(record, mode="append", msg_record=msg_record)
+        logger.debug(f"Appended message to record {record['id']} and saved.")
+
+
+async def _save_new_record(record: Dict, initial_messages: List[Dict], compact_ts: str):
+    """下载新记录初始消息中的图片（作为一批并发下载），然后写入头信息与初始消息"""
+    await process_images_in_messages(initial_messages, record["group_id"], record["associated_images"], compact_ts)
+    await save_at_record(record, mode="create", messages=initial_messages)
+    logger.info(f"New AT detected. Immediately created and saved record {record['id']}.")
+
+
 # --- 网络与工具函数 ---
+_download_sem = asyncio.Semaphore(8)  # 图片并发下载上限
+_inflight_downloads: Dict[Path, "asyncio.Task[bool]"] = {}  # 保存路径 -> 进行中的下载任务
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+def _get_http_session() -> aiohttp.ClientSession:
+    """获取复用连接的 HTTP 会话，首次使用时创建"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, limit_per_host=8),
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+    return _http_session
+
+
+@on_core_shutdown
+async def _close_http_session():
+    """关闭 HTTP 会话"""
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+
+async def download_file(url: str, save_path: Path):
+    """下载文件到指定路径，失败时抛出异常"""
+    async with _get_http_session().get(url) as resp:
+        resp.raise_for_status()
+        data = await resp.read()
+    async with aiofiles.open(save_path, "wb") as f:
+        await f.write(data)
+
+
+def _convert_to_webp(save_path: Path):
+    """将图片转换为webp格式，并删除原始文件"""
+    from PIL import Image
+
+    with Image.open(save_path) as img:
+        webp_path = save_path.with_suffix(".webp")
+        img.save(webp_path, "WEBP", method=0, quality=80)
+    # 删除原始文件
+    if save_path.exists() and save_path != webp_path:
+        os.remove(save_path)
+
+
+def _load_avatar(path: Path) -> "Image.Image":
+    """解码头像，缩放到绘制尺寸并裁成圆形（写入 alpha 通道），供线程中调用"""
+    from PIL import Image
+
+    img = _open_image(path, AVATAR_DECODE_SIZE).convert("RGBA")
+    img = img.resize((AVATAR_SIZE, AVATAR_SIZE), Image.Resampling.BILINEAR)
+    img.putalpha(_circle_mask(AVATAR_SIZE))
+    return img
+
+
+def _cache_avatar(src_path: Path, cache_path: Path) -> "Image.Image":
+    """处理下载的原始头像并以 PNG 缓存处理结果，之后直接读取无需再解码缩放，供线程中调用"""
+    img = _load_avatar(src_path)
+    img.save(cache_path, "PNG")
+    src_path.unlink(missing_ok=True)
+    return img
+
+
+def _open_image(path: Path, draft_size: Optional[Tuple[int, int]] = None) -> "Image.Image":
+    """打开并解码图片，供线程中调用；指定 draft_size 时 JPEG 会直接按比例缩小解码"""
+    from PIL import Image
+
+    img = Image.open(path)
+    if draft_size:
+        img.draft("RGB", draft_size)
+    img.load()
+    return img
+
+
 async def download_image(url: str, save_path: Path) -> bool:
     """下载图片到本地并转换为webp"""
     try:
         save_path.parent.mkdir(parents=True, exist_ok=True)
-        # 使用gs的下载函数
-        await download(url, save_path.parent, save_path.name, tag="[AT_Tracker]")
+        # 限制同时进行的下载数量
+        async with _download_sem:
+            await download_file(url, save_path)
 
-        # 转换为webp格式
+        # 转换为webp格式，编解码在线程中进行，不阻塞事件循环
         try:
-            img = Image.open(save_path)
-            webp_path = save_path.with_suffix(".webp")
-            img.save(webp_path, "WEBP")
-            # 删除原始文件
-            if save_path.exists() and save_path != webp_path:
-                os.remove(save_path)
+            await asyncio.to_thread(_convert_to_webp, save_path)
             return True
         except Exception as e:
             logger.warning(f"转换图片为webp失败，保留原始格式: {e}")
@@ -180,18 +755,35 @@ async def download_image(url: str, save_path: Path) -> bool:
     return False
 
 
-async def get_user_avatar(qq: str) -> Optional[Image.Image]:
-    """获取用户QQ头像"""
+async def get_user_avatar(qq: str) -> Optional["Image.Image"]:
+    """获取用户QQ头像，返回已缩放到 AVATAR_SIZE 的圆形 RGBA 图片（副本，调用方可随意修改）"""
+    cached = _avatar_lru.get(qq)
+    if cached is not None and get_config("EnableAvatarCache"):
+        _avatar_lru.move_to_end(qq)
+        return cached.copy()
+
+    # 同一QQ的并发请求只获取一次，避免多个协程同时读写同一个头像文件
+    task = _inflight_avatars.get(qq)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_user_avatar(qq))
+        _inflight_avatars[qq] = task
+        task.add_done_callback(lambda _: _inflight_avatars.pop(qq, None))
+    img = await asyncio.shield(task)
+    return img.copy() if img is not None else None
+
+
+async def _fetch_user_avatar(qq: str) -> Optional["Image.Image"]:
+    """下载或从缓存读取头像，只应经由 get_user_avatar 调用"""
     try:
         if not get_config("EnableAvatarCache"):
             # 不启用缓存，直接下载到临时文件
             avatar_url = f"http://q1.qlogo.cn/g?b=qq&nk={qq}&s=640"
-            temp_file = f"{qq}_temp.jpg"
-            await download(avatar_url, AVATAR_CACHE_PATH, temp_file, tag="[AT_Tracker]")
+            temp_file = f"{qq}_{uuid.uuid4().hex}_temp.jpg"
             avatar_path = AVATAR_CACHE_PATH / temp_file
+            await download_file(avatar_url, avatar_path)
             if avatar_path.exists():
                 try:
-                    img = Image.open(avatar_path)
+                    img = await asyncio.to_thread(_load_avatar, avatar_path)
                     avatar_path.unlink()
                     return img
                 except Exception as e:
@@ -203,25 +795,36 @@ async def get_user_avatar(qq: str) -> Optional[Image.Image]:
                     return None
             return None
 
-        # 启用缓存
-        avatar_path = AVATAR_CACHE_PATH / f"{qq}.jpg"
-        if avatar_path.exists():
-            return Image.open(avatar_path)
-
-        avatar_url = f"http://q1.qlogo.cn/g?b=qq&nk={qq}&s=640"
-        await download(avatar_url, AVATAR_CACHE_PATH, f"{qq}.jpg", tag="[AT_Tracker]")
-
-        if avatar_path.exists():
-            return Image.open(avatar_path)
-        return None
+        # 启用缓存：内存（见 get_user_avatar）-> 磁盘 -> 网络
+        # 磁盘上缓存的是已缩放、已裁圆的 PNG；原始 JPEG 仅在下载后处理一次
+        cache_path = AVATAR_CACHE_PATH / f"{qq}.png"
+        if cache_path.exists():
+            img = await asyncio.to_thread(_open_image, cache_path)
+        else:
+            avatar_path = AVATAR_CACHE_PATH / f"{qq}.jpg"
+            if not avatar_path.exists():
+                avatar_url = f"http://q1.qlogo.cn/g?b=qq&nk={qq}&s=640"
+                await download_file(avatar_url, avatar_path)
+            if not avatar_path.exists():
+                return None
+            img = await asyncio.to_thread(_cache_avatar, avatar_path, cache_path)
+
+        _avatar_lru[qq] = img
+        if len(_avatar_lru) > AVATAR_LRU_SIZE:
+            _avatar_lru.popitem(last=False)
+        return img
     except Exception as e:
         logger.error(f"获取QQ头像失败 {qq}: {e}")
         return None
 
 
-async def parse_and_enrich_message(bot: Bot, group_id: int, event: Event) -> List[Dict]:
-    """解析消息内容，并为at消息段补充群名片信息"""
+async def parse_and_enrich_message(bot: Bot, group_id: int, event: Event) -> Tuple[List[Dict], List[Dict]]:
+    """解析消息内容，并为at消息段补充群名片信息
+
+    返回 (消息内容列表, at目标列表)
+    """
     content_list = []
+    at_items = []
 
     # 处理文本内容
     if event.text:
@@ -243,22 +846,69 @@ async def parse_and_enrich_message(bot: Bot, group_id: int, event: Event) -> Lis
             # 具体的昵称显示交给生成图片时的上下文处理。
             card = "全体成员" if qq == "all" else qq
             content_list.append({"type": "at", "qq": qq, "card": card})
-
-    return content_list
-
-async def process_images_in_message(msg_record: Dict, group_id: int, associated_images: List[str]):
-    """检查消息中是否有图片，下载它们并更新关联图片列表"""
-    for item in msg_record.get("content", []):
-        if item["type"] == "image":
-            url = item["url"]
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            img_name = f"{timestamp}_{hashlib.md5(url.encode()).hexdigest()}.webp"
-            img_path = RECORD_PATH / str(group_id) / img_name
-            if not img_path.exists():
-                await download_image(url, img_path)
-            item["local_path"] = str(img_path)
-            if img_name not in associated_images:
-                associated_images.append(img_name)
+            at_items.append({"qq": qq, "card": card})
+
+    return content_list, at_items
+
+async def _download_once(url: str, save_path: Path) -> bool:
+    """同一保存路径的并发下载只发起一次，其余调用方等待同一个结果"""
+    task = _inflight_downloads.get(save_path)
+    if task is None:
+        task = asyncio.ensure_future(download_image(url, save_path))
+        _inflight_downloads[save_path] = task
+        task.add_done_callback(lambda _: _inflight_downloads.pop(save_path, None))
+    # shield：某个等待方被取消时不影响共享的下载任务
+    return await asyncio.shield(task)
+
+
+async def download_many(downloads: Dict[Path, str]) -> List[bool]:
+    """批量并发下载图片 {保存路径: url}，共用同一个 HTTP 会话的连接池"""
+    results = await asyncio.gather(
+        *(_download_once(url, save_path) for save_path, url in downloads.items()),
+        return_exceptions=True,
+    )
+    return [result is True for result in results]
+
+
+def _short_hash(text: str, digest_size: int) -> str:
+    """生成用于文件名/记录ID的短哈希，仅作标识用途，不涉及安全"""
+    return blake2b(text.encode(), digest_size=digest_size, usedforsecurity=False).hexdigest()
+
+
+async def process_images_in_messages(
+    messages: List[Dict], group_id: int, associated_images: List[str], compact_ts: Optional[str] = None
+):
+    """检查消息中是否有图片，一次性批量下载它们并更新关联图片列表
+
+    compact_ts 为调用方已算好的时间戳，用作新图片文件名前缀
+    """
+    timestamp = compact_ts or now_strs()[1]
+    downloads: Dict[Path, str] = {}
+    images = []
+    for msg_record in messages:
+        for item in msg_record.get("content", []):
+            if item["type"] == "image":
+                local_path = item.get("local_path")
+                if local_path:
+                    # 已处理过的图片（如上下文中的旧消息）直接复用原文件
+                    img_path = Path(local_path)
+                    images.append((item, img_path.name, img_path))
+                    continue
+                url = item["url"]
+                img_name = f"{timestamp}_{_short_hash(url, 8)}.webp"
+                img_path = RECORD_PATH / str(group_id) / img_name
+                # 同一批次内相同的图片只下载一次
+                if img_path not in downloads and not img_path.exists():
+                    downloads[img_path] = url
+                images.append((item, img_name, img_path))
+
+    if downloads:
+        await download_many(downloads)
+
+    for item, img_name, img_path in images:
+        item["local_path"] = str(img_path)
+        if img_name not in associated_images:
+            associated_images.append(img_name)
 
 
 async def process_group_message(bot: Bot, event: Event):
@@ -273,75 +923,94 @@ async def process_group_message(bot: Bot, event: Event):
     tracking_count = get_config("TRACKING_COUNT")
 
     # Part 1: 消息预处理和缓存
-    if group_id not in message_cache:
-        message_cache[group_id] = deque(maxlen=cache_size)
+    group_cache = message_cache.get(group_id)
+    if group_cache is not None:
+        message_cache.move_to_end(group_id)
+    else:
+        group_cache = message_cache[group_id] = deque(maxlen=cache_size)
+        if len(message_cache) > MESSAGE_CACHE_GROUPS:
+            message_cache.popitem(last=False)
 
     # 获取用户昵称
     card = event.sender.get("nickname", str(user_id)) if event.sender else str(user_id)
 
-    content = await parse_and_enrich_message(bot, group_id, event)
+    content, at_targets = await parse_and_enrich_message(bot, group_id, event)
+    time_str, compact_ts = now_strs()
 
     msg_record = {
         "user_id": user_id,
         "card": card,
-        "time": datetime.now().strftime("%Y%m%d %H:%M:%S"),
+        "time": time_str,
         "content": content,
         "message_id": event.msg_id,
     }
 
-    message_cache[group_id].append(msg_record)
+    group_cache.append(msg_record)
 
     # Part 2: 处理并更新所有活跃的追踪会话
-    sessions_to_keep = []
-    if group_id in active_at_tracking:
-        for session in active_at_tracking[group_id]:
-            # 查找与会话关联的内存中的记录
-            record_to_update = next(
-                (r for r in at_records.get(group_id, []) if r["id"] == session["record_id"]),
-                None,
+    sessions = active_at_tracking.get(group_id)
+    if sessions:
+        # 本条消息的图片只下载一次，再关联到各个会话的记录
+        msg_images: List[str] = []
+        images_task = None
+        if any(item["type"] == "image" for item in content):
+            images_task = asyncio.ensure_future(
+                process_images_in_messages([msg_record], group_id, msg_images, compact_ts)
             )
 
-            if record_to_update:
-                # 实时追加消息并保存
-                await process_images_in_message(msg_record, group_id, record_to_update["associated_images"])
-                record_to_update["messages"].append(msg_record)
-                save_at_record(record_to_update)
-                logger.debug(f"Appended message to record {session['record_id']} and saved.")
+        # 内存中的会话与记录在此同步更新完毕（期间没有 await），并发到达的消息不会重复计入已结束的会话
+        write_tasks = []
+        for session_key, session in list(sessions.items()):
+            # 查找与会话关联的内存中的记录
+            record_to_update = at_records_by_id.get(group_id, {}).get(session["record_id"])
 
-                session["remaining"] -= 1
-                if session["remaining"] > 0:
-                    sessions_to_keep.append(session)
-                else:
-                    logger.info(f"AT tracking session for record {session['record_id']} has finished.")
-            else:
+            if record_to_update is None:
                 logger.warning(
                     f"Could not find record for active tracking session {session['record_id']}. Removing session."
                 )
+                sessions.pop(session_key, None)
+                continue
+
+            _append_record_message(record_to_update, msg_record)
+            session["remaining"] -= 1
+            finished = session["remaining"] <= 0
+            if finished:
+                sessions.pop(session_key, None)
+
+            # 文件写入按记录排队，在图片下载完成后依次执行
+            write_tasks.append(
+                _queue_record_write(
+                    record_to_update,
+                    _save_tracked_message(record_to_update, msg_record, finished, images_task, msg_images),
+                )
+            )
+
+        if not sessions:
+            active_at_tracking.pop(group_id, None)
 
-    if sessions_to_keep:
-        active_at_tracking[group_id] = sessions_to_keep
-    elif group_id in active_at_tracking:
-        del active_at_tracking[group_id]
+        if write_tasks:
+            await asyncio.gather(*write_tasks, return_exceptions=True)
+        elif images_task is not None:
+            images_task.cancel()
 
     # Part 3: 检查当前消息是否需要开启新的追踪会话
-    has_at = any(item["type"] == "at" for item in content)
-    at_targets = [{"qq": item["qq"], "card": item["card"]} for item in content if item["type"] == "at"]
+    has_at = bool(at_targets)
 
-    if has_at and str(user_id) != bot.bot_self_id:
-        is_new_session_needed = True
-        current_targets_qq = {str(t.get("qq")) for t in at_targets}
+    user_id_str = str(user_id)
+    if has_at and user_id_str != bot.bot_self_id:
+        # 以 (发送者, AT 目标集合) 为键，O(1) 判断是否已有相同会话
+        session_key = (user_id_str, frozenset(str(t["qq"]) for t in at_targets))
 
-        if group_id in active_at_tracking:
-            for session in active_at_tracking[group_id]:
-                session_sender_id = str(session["sender_id"])
-                session_targets_qq = {str(t.get("qq")) for t in session["targets"]}
-                if session_sender_id == str(user_id) and session_targets_qq == current_targets_qq:
-                    is_new_session_needed = False
-                    break
+        if session_key not in active_at_tracking.get(group_id, {}):
+            # 新记录需插入群组的记录列表，群组未加载时会在此等待读取
+            group_records = await _ensure_group_loaded(group_id)
+            # 等待期间相同的会话可能已由其他消息创建
+            if session_key in active_at_tracking.get(group_id, {}):
+                return
 
-        if is_new_session_needed:
+            # 以下直到登记会话均为同步操作，期间不会有其他消息插入
             # 寻找上下文
-            cache_list = list(message_cache[group_id])
+            cache_list = list(group_cache)
             first_sender_msg_index = -1
             for i, msg in enumerate(cache_list):
                 if msg["user_id"] == user_id:
@@ -351,7 +1020,7 @@ async def process_group_message(bot: Bot, event: Event):
             start_index = max(0, first_sender_msg_index - 1) if first_sender_msg_index != -1 else 0
             initial_messages = cache_list[start_index:]
 
-            record_id = f"{group_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{hashlib.md5(str(event.msg_id).encode()).hexdigest()[:8]}"
+            record_id = f"{group_id}_{compact_ts}_{_short_hash(str(event.msg_id), 4)}"
 
             # 创建初始记录
             at_record = {
@@ -359,21 +1028,17 @@ async def process_group_message(bot: Bot, event: Event):
                 "group_id": group_id,
                 "sender_id": user_id,
                 "targets": at_targets,
-                "start_time": datetime.now().strftime("%Y%m%d %H:%M:%S"),
-                "messages": initial_messages,
+                "start_time": time_str,
+                # 复制一份，后续追加的消息不影响创建时写入的初始消息
+                "messages": list(initial_messages),
                 "associated_images": [],
             }
+            _index_record(at_record)
 
-            # 处理初始消息中的图片
-            for msg in initial_messages:
-                await process_images_in_message(msg, group_id, at_record["associated_images"])
-
-            # 立即写入内存和文件
-            if group_id not in at_records:
-                at_records[group_id] = []
-            at_records[group_id].append(at_record)
-            save_at_record(at_record)
-            logger.info(f"New AT detected. Immediately created and saved record {record_id}.")
+            # 立即写入内存，文件写入（含图片下载）排入该记录的写入队列，先于后续追加的消息执行
+            bisect.insort(group_records, at_record, key=_start_time_key)
+            _add_record_index(group_id, at_record)
+            create_task = _queue_record_write(at_record, _save_new_record(at_record, initial_messages, compact_ts))
 
             # 创建新的追踪会话
             new_session = {
@@ -383,10 +1048,9 @@ async def process_group_message(bot: Bot, event: Event):
                 "remaining": tracking_count,
             }
 
-            if group_id not in active_at_tracking:
-                active_at_tracking[group_id] = []
-            active_at_tracking[group_id].append(new_session)
+            active_at_tracking.setdefault(group_id, {})[session_key] = new_session
             logger.info(f"Started new AT tracking session for record {record_id}. Tracking next {tracking_count} messages.")
+            await create_task
 
 
 # --- 消息监听：自动追踪所有群消息 ---
@@ -426,44 +1090,45 @@ async def handle_who_at_me(bot: Bot, event: Event):
         # 优先使用群名片，其次昵称，最后保底使用QQ号
         target_name = event.sender.get("card") or event.sender.get("nickname") or user_id
 
-    group_at_records = at_records.get(group_id, [])
-
-    valid_records = []
-    cutoff_date = datetime.now() - timedelta(days=retention_days)
-    for record in group_at_records:
-        try:
-            record_time = datetime.strptime(record["start_time"], "%Y%m%d %H:%M:%S")
-            if record_time >= cutoff_date:
-                valid_records.append(record)
-        except (ValueError, KeyError):
+    # 确保该群组的记录与索引已加载
+    await _ensure_group_loaded(group_id)
+    records_by_id = at_records_by_id.get(group_id, {})
+    by_target = at_records_by_target.get(group_id, {})
+    record_ids = by_target.get(user_id, set()) | by_target.get("all", set())
+
+    user_at_records = []
+    cutoff_str = get_cutoff_str(retention_days)
+    for record_id in record_ids:
+        record = records_by_id.get(record_id)
+        if record is None:
+            continue
+        start_time = record.get("start_time")
+        if not isinstance(start_time, str) or len(start_time) != TIME_STR_LEN:
             logger.warning(f"记录 {record.get('id', 'N/A')} 的日期格式不正确，已跳过。")
             continue
-
-    user_at_records = [
-        record
-        for record in valid_records
-        if any(str(t.get("qq")) == user_id or t.get("qq") == "all" for t in record.get("targets", []))
-    ]
+        if start_time >= cutoff_str:
+            user_at_records.append(record)
 
     # 规则修改: 结束的session才决定最终要不要展示
     finalized_user_records = []
     for record in user_at_records:
         sender_id = str(record["sender_id"])
         messages = record["messages"]
+        uids = record["_uids"]
         # 查找原始的@消息之后，发送者是否再次发言
-        at_msg_index = -1
-        for i, msg in enumerate(messages):
-            if any(item.get("type") == "at" for item in msg.get("content", [])) and str(msg.get("user_id")) == sender_id:
-                at_msg_index = i
-                break
+        at_msg_index = next(
+            (i for i, (uid, has_at) in enumerate(zip(uids, record["_at_flags"])) if has_at and uid == sender_id),
+            -1,
+        )
 
         if at_msg_index == -1:
             continue
 
         last_sender_index_after_at = -1
-        for i in range(at_msg_index + 1, len(messages)):
-            if str(messages[i].get("user_id")) == sender_id:
+        for i in range(len(uids) - 1, at_msg_index, -1):
+            if uids[i] == sender_id:
                 last_sender_index_after_at = i
+                break
 
         # 确定最终消息范围
         start_index = 0
@@ -481,17 +1146,17 @@ async def handle_who_at_me(bot: Bot, event: Event):
         return await bot.send("最近没有人@你哦")
 
     try:
-        images = []
         # 构建替换字典：{QQ号: 昵称}
         name_map = {user_id: target_name} if target_name != user_id else {}
 
-        for record in recent_records:
-            # 传入 name_map
-            img = await generate_chat_image(bot, record, name_map=name_map)
-            if img:
-                # 转换图片为可发送格式
-                converted_img = await convert_img(img)
-                images.append(converted_img)
+        # 各条记录并发渲染，再在渲染线程池中并行编码为 PNG 字节
+        rendered = await asyncio.gather(
+            *(generate_chat_image(bot, record, name_map=name_map) for record in recent_records)
+        )
+        loop = asyncio.get_running_loop()
+        images = await asyncio.gather(
+            *(loop.run_in_executor(_render_pool, _encode_png, img) for img in rendered if img)
+        )
 
         if not images:
             logger.error("没有生成任何图片")
@@ -510,22 +1175,35 @@ async def handle_who_at_me(bot: Bot, event: Event):
         logger.error("生成AT记录图片失败:\n" + traceback.format_exc())
         logger.error(f"处理查询命令失败: {e}")
 
-def wrap_text(text: str, font: ImageFont.FreeTypeFont, max_width: int) -> str:
+def wrap_text(text: str, font: "ImageFont.FreeTypeFont", max_width: int) -> str:
     lines = []
+    char_widths: Dict[str, float] = {}  # 同一段文本中重复字符较多（尤其是中文），缓存单字宽度
     for paragraph in text.split("\n"):
         if font.getbbox(paragraph)[2] <= max_width:
             lines.append(paragraph)
         else:
-            current_line = ""
+            # 逐字累加宽度，避免每个字符都重新测量整行
+            current_line = []
+            line_width = 0.0
             for char in paragraph:
-                if font.getbbox(current_line + char)[2] <= max_width:
-                    current_line += char
-                else:
-                    lines.append(current_line)
-                    current_line = char
-            lines.append(current_line)
+                char_width = char_widths.get(char)
+                if char_width is None:
+                    char_width = char_widths[char] = font.getlength(char)
+                if current_line and line_width + char_width > max_width:
+                    lines.append("".join(current_line))
+                    current_line = []
+                    line_width = 0.0
+                current_line.append(char)
+                line_width += char_width
+            lines.append("".join(current_line))
     return "\n".join(lines)
 
+
+@functools.lru_cache(maxsize=512)
+def _wrap(text: str, size: int, max_width: int) -> str:
+    """按字号缓存的 wrap_text，同一次查询中重复出现的消息无需重新排版"""
+    return wrap_text(text, _load_font(size), max_width)
+
 @at_tracker_sv.on_command(("清除at记录", "清空at记录", "删除at记录"), block=True)
 async def handle_clear_at_records(bot: Bot, event: Event):
     """手动清除当前群组的AT记录"""
@@ -540,8 +1218,7 @@ async def handle_clear_at_records(bot: Bot, event: Event):
 
     try:
         # 1. 清除内存中的记录
-        if group_id in at_records:
-            at_records[group_id] = []
+        _set_group_records(group_id, [])
 
         # 2. 清除活跃的追踪会话（防止正在进行的追踪写入已删除的文件）
         if group_id in active_at_tracking:
@@ -562,143 +1239,211 @@ async def handle_clear_at_records(bot: Bot, event: Event):
         logger.error(f"清除记录失败: {e}")
         await bot.send(f"清除记录时发生错误: {e}")
 
-async def generate_chat_image(bot: Bot, record: Dict, name_map: Dict[str, str] = None) -> Optional[Image.Image]:
-    try:
-        width, padding = 700, 20
-        avatar_size, msg_padding = 45, 15
-        bubble_padding, max_bubble_width = 12, 450
-
-        try:
-            cjk_font = ImageFont.truetype(str(font_path), 18)
-            small_cjk_font = ImageFont.truetype(str(font_path), 14)
-            time_cjk_font = ImageFont.truetype(str(font_path), 12)
-
-        except Exception as e:
-            logger.warning(f"加载字体失败，将使用默认字体: {e}")
-            cjk_font = small_cjk_font = time_cjk_font = ImageFont.load_default()
-
-        img = Image.new("RGB", (width, 20000), color="#f5f5f5")
-        draw = ImageDraw.Draw(img)
-
-        draw.rectangle([0, 0, width, 50], fill="#4a90e2")
-        title = f"AT记录 - {record.get('start_time', '')}" # 这里的名字留着，不过分吧
-        draw.text((padding, 15), title, font=cjk_font, fill="#ffffff")
+@functools.lru_cache(maxsize=8)
+def _load_font(size: int) -> "ImageFont.FreeTypeFont":
+    """加载指定字号的字体，结果会被缓存"""
+    from PIL import ImageFont
 
-        current_y = 65
-
-        messages = record.get("messages", [])
-        for msg in messages:
-            user_id = str(msg.get("user_id", ""))
-
-            avatar_x, avatar_y = padding, current_y
-
-            avatar_img = await get_user_avatar(user_id)
-            if avatar_img:
-                avatar_img = avatar_img.resize((avatar_size, avatar_size), Image.Resampling.LANCZOS)
-                mask = Image.new("L", (avatar_size, avatar_size), 0)
-                mask_draw = ImageDraw.Draw(mask)
-                mask_draw.ellipse([0, 0, avatar_size, avatar_size], fill=255)
-                img.paste(avatar_img, (avatar_x, avatar_y), mask)
-
-            content_x = avatar_x + avatar_size + msg_padding
-            content_y = current_y
-
-            card = msg.get("card", "Unknown")
-            draw.text((content_x, content_y), card, font=small_cjk_font, fill="#666666")
-            content_y += 22
-
-            inner_content_y = content_y
-
-            for item in msg.get("content", []):
-                item_spacing = 8
-
-                if item["type"] == "text":
-                    wrapped_text = wrap_text(item["content"], cjk_font, max_bubble_width)
-                    bbox = draw.multiline_textbbox((0, 0), wrapped_text, font=cjk_font, spacing=5)
-                    text_width = bbox[2] - bbox[0]
-                    text_height = bbox[3] - bbox[1]
+    try:
+        return ImageFont.truetype(str(font_path), size)
+    except Exception as e:
+        logger.warning(f"加载字体失败，将使用默认字体: {e}")
+        return ImageFont.load_default()
+
+
+@functools.cache
+def _get_fonts() -> Dict[str, "ImageFont.FreeTypeFont"]:
+    """生成图片所需的全部字体，首次使用时加载一次"""
+    return {name: _load_font(size) for name, size in FONT_SIZES.items()}
+
+
+@functools.lru_cache(maxsize=4)
+def _circle_mask(size: int) -> "Image.Image":
+    """圆形头像遮罩，按尺寸缓存"""
+    from PIL import Image, ImageDraw
+
+    mask = Image.new("L", (size, size), 0)
+    ImageDraw.Draw(mask).ellipse([0, 0, size, size], fill=255)
+    return mask
+
+
+def _generate_chat_image_sync(
+    record: Dict, avatars: Dict[str, "Image.Image"], name_map: Dict[str, str] = None
+) -> "Image.Image":
+    """绘制聊天记录图片（同步，在渲染线程池中执行），头像需预先获取"""
+    from PIL import Image, ImageDraw
+
+    width, padding = 700, 20
+    avatar_size, msg_padding = AVATAR_SIZE, 15
+    bubble_padding, max_bubble_width = 12, 450
+    item_spacing = 8
+    placeholder_w, placeholder_h = 150, 100
+
+    fonts = _get_fonts()
+    cjk_font, small_cjk_font, time_cjk_font = fonts["cjk"], fonts["small"], fonts["time"]
+
+    # 仅用于测量文本尺寸
+    measure_draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+
+    def measure_message(msg: Dict):
+        """计算单条消息的排版，返回 (各元素排版, 时间文本, 消息高度)"""
+        layout = []
+        content_height = 22
+        for item in msg.get("content", []):
+            if item["type"] == "text":
+                wrapped_text = _wrap(item["content"], FONT_SIZES["cjk"], max_bubble_width)
+                bbox = measure_draw.multiline_textbbox((0, 0), wrapped_text, font=cjk_font, spacing=5)
+                text_width, text_height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+                layout.append(("text", wrapped_text, text_width, text_height))
+                content_height += text_height + bubble_padding * 2 + item_spacing
+
+            elif item["type"] == "image":
+                local_path = item.get("local_path")
+                img_content = None
+                try:
+                    if local_path and Path(local_path).exists():
+                        with Image.open(local_path) as opened:
+                            # JPEG 直接按比例缩小解码；预览图很小，BILINEAR 与 LANCZOS 肉眼无差别
+                            opened.draft("RGB", (500, 400))
+                            opened.thumbnail((250, 200), Image.Resampling.BILINEAR)
+                            img_content = opened
+                except Exception:
+                    img_content = None
+                layout.append(("image", img_content, 0, 0))
+                content_height += (img_content.height if img_content else placeholder_h) + item_spacing
+
+            elif item["type"] == "at":
+                qq_id = str(item.get('qq', ''))
+
+                # 优先使用 name_map 中的昵称，否则使用记录中的 card，最后保底用 qq_id
+                card_text = item.get('card', qq_id)
+                if name_map and qq_id in name_map:
+                    card_text = name_map[qq_id]
+
+                # 统一添加 @ 前缀
+                at_text = f"@{card_text}"
+
+                bbox = measure_draw.textbbox((0, 0), at_text, font=cjk_font)
+                text_width, text_height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+                layout.append(("at", at_text, text_width, text_height))
+                content_height += text_height + bubble_padding + item_spacing
+
+        time_str = msg.get("time", "").split(" ")[1] if " " in msg.get("time", "") else ""
+        if time_str:
+            content_height += 15
+
+        return layout, time_str, max(avatar_size, content_height)
+
+    # 第一遍：测量所有消息的高度，按实际高度分配画布
+    messages = record.get("messages", [])
+    layouts = [measure_message(msg) for msg in messages]
+    final_height = 65 + sum(height + msg_padding for _, _, height in layouts) + padding
+
+    img = Image.new("RGB", (width, final_height), color="#f5f5f5")
+    draw = ImageDraw.Draw(img)
+
+    draw.rectangle([0, 0, width, 50], fill="#4a90e2")
+    title = f"AT记录 - {record.get('start_time', '')}" # 这里的名字留着，不过分吧
+    draw.text((padding, 15), title, font=cjk_font, fill="#ffffff")
+
+    current_y = 65
+
+    # 第二遍：按测量结果绘制
+    for msg, (layout, time_str, msg_height) in zip(messages, layouts):
+        user_id = str(msg.get("user_id", ""))
+
+        avatar_x, avatar_y = padding, current_y
+
+        avatar_img = avatars.get(user_id)
+        if avatar_img:
+            img.paste(avatar_img, (avatar_x, avatar_y), avatar_img)
+
+        content_x = avatar_x + avatar_size + msg_padding
+        content_y = current_y
+
+        card = msg.get("card", "Unknown")
+        draw.text((content_x, content_y), card, font=small_cjk_font, fill="#666666")
+        content_y += 22
+
+        inner_content_y = content_y
+
+        for kind, payload, text_width, text_height in layout:
+            if kind == "text":
+                bubble_rect = (
+                    content_x,
+                    inner_content_y,
+                    content_x + text_width + bubble_padding * 2,
+                    inner_content_y + text_height + bubble_padding * 2,
+                )
+                draw.rounded_rectangle(bubble_rect, radius=10, fill="#ffffff")
+                draw.multiline_text(
+                    (content_x + bubble_padding, inner_content_y + bubble_padding),
+                    payload,
+                    font=cjk_font,
+                    fill="#333333",
+                    spacing=5,
+                )
+                inner_content_y += text_height + bubble_padding * 2 + item_spacing
 
-                    bubble_rect = (
-                        content_x,
-                        inner_content_y,
-                        content_x + text_width + bubble_padding * 2,
-                        inner_content_y + text_height + bubble_padding * 2,
-                    )
-                    draw.rounded_rectangle(bubble_rect, radius=10, fill="#ffffff")
-                    draw.multiline_text(
-                        (content_x + bubble_padding, inner_content_y + bubble_padding),
-                        wrapped_text,
-                        font=cjk_font,
-                        fill="#333333",
-                        spacing=5,
+            elif kind == "image":
+                if payload is not None:
+                    img.paste(payload, (content_x, inner_content_y))
+                    inner_content_y += payload.height + item_spacing
+                else:
+                    draw.rounded_rectangle(
+                        (content_x, inner_content_y, content_x + placeholder_w, inner_content_y + placeholder_h),
+                        radius=10,
+                        fill="#e0e0e0",
                     )
-                    inner_content_y += text_height + bubble_padding * 2 + item_spacing
+                    draw.text((content_x + 55, inner_content_y + 40), "[图片]", font=cjk_font, fill="#999999")
+                    inner_content_y += placeholder_h + item_spacing
+
+            elif kind == "at":
+                at_rect = (
+                    content_x,
+                    inner_content_y,
+                    content_x + text_width + bubble_padding,
+                    inner_content_y + text_height + bubble_padding,
+                )
+                draw.rounded_rectangle(at_rect, radius=8, fill="#e3f2fd")
+                draw.text(
+                    (content_x + bubble_padding / 2, inner_content_y + bubble_padding / 2),
+                    payload,
+                    font=small_cjk_font,
+                    fill="#1976d2",
+                )
+                inner_content_y += text_height + bubble_padding + item_spacing
 
-                elif item["type"] == "image":
-                    local_path = item.get("local_path")
-                    try:
-                        if not (local_path and Path(local_path).exists()):
-                            raise FileNotFoundError
-                        with Image.open(local_path) as img_content:
-                            img_content.thumbnail((250, 200), Image.Resampling.LANCZOS)
-                            img.paste(img_content, (content_x, inner_content_y))
-                            inner_content_y += img_content.height + item_spacing
-                    except Exception:
-                        placeholder_w, placeholder_h = 150, 100
-                        draw.rounded_rectangle(
-                            (content_x, inner_content_y, content_x + placeholder_w, inner_content_y + placeholder_h),
-                            radius=10,
-                            fill="#e0e0e0",
-                        )
-                        draw.text((content_x + 55, inner_content_y + 40), "[图片]", font=cjk_font, fill="#999999")
-                        inner_content_y += placeholder_h + item_spacing
-
-                elif item["type"] == "at":
-                    qq_id = str(item.get('qq', ''))
-
-                    # 优先使用 name_map 中的昵称，否则使用记录中的 card，最后保底用 qq_id
-                    card_text = item.get('card', qq_id)
-                    if name_map and qq_id in name_map:
-                        card_text = name_map[qq_id]
-
-                    # 统一添加 @ 前缀
-                    at_text = f"@{card_text}"
-
-                    bbox = draw.textbbox((0, 0), at_text, font=cjk_font)
-                    text_width, text_height = bbox[2] - bbox[0], bbox[3] - bbox[1]
-
-                    at_rect = (
-                        content_x,
-                        inner_content_y,
-                        content_x + text_width + bubble_padding,
-                        inner_content_y + text_height + bubble_padding,
-                    )
-                    draw.rounded_rectangle(at_rect, radius=8, fill="#e3f2fd")
-                    draw.text(
-                        (content_x + bubble_padding / 2, inner_content_y + bubble_padding / 2),
-                        at_text,
-                        font=small_cjk_font,
-                        fill="#1976d2",
-                    )
-                    inner_content_y += text_height + bubble_padding + item_spacing
+        if time_str:
+            draw.text((content_x, inner_content_y), time_str, font=time_cjk_font, fill="#999999")
 
-            avatar_bottom = avatar_y + avatar_size
-            content_bottom = inner_content_y
+        current_y += msg_height + msg_padding
 
-            time_str = msg.get("time", "").split(" ")[1] if " " in msg.get("time", "") else ""
-            if time_str:
-                draw.text((content_x, content_bottom), time_str, font=time_cjk_font, fill="#999999")
-                content_bottom += 15
+    return img
 
-            current_y = max(avatar_bottom, content_bottom) + msg_padding
 
-        final_height = current_y + padding
-        img = img.crop((0, 0, width, final_height))
-        return img
+async def generate_chat_image(bot: Bot, record: Dict, name_map: Dict[str, str] = None) -> Optional["Image.Image"]:
+    try:
+        # 先并发获取所有头像，再将绘制交给渲染线程池，避免阻塞事件循环
+        user_ids = list(dict.fromkeys(str(msg.get("user_id", "")) for msg in record.get("messages", [])))
+        avatar_list = await asyncio.gather(*(get_user_avatar(user_id) for user_id in user_ids))
+        avatars = {user_id: avatar for user_id, avatar in zip(user_ids, avatar_list) if avatar is not None}
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _render_pool, functools.partial(_generate_chat_image_sync, record, avatars, name_map)
+        )
 
     except Exception as e:
         logger.error(f"生成聊天记录图片失败: {e}")
         return None
 
+
+def _encode_png(img: "Image.Image") -> bytes:
+    """将渲染结果编码为 PNG 字节（与 convert_img 的输出一致），供渲染线程池调用"""
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="PNG")
+    return buf.getvalue()
+
 # 初始化
 asyncio.create_task(init())